@@ -0,0 +1,28 @@
+"""
+Gunicorn config cho Render:
+    gunicorn -c gunicorn_conf.py ky_luat_bot:app
+"""
+
+import os
+
+# BIND_UDS=/tmp/bot.sock → nghe Unix socket khi có reverse proxy cùng máy
+# (proxy_pass http://unix:/tmp/bot.sock). Render chỉ có ingress HTTPS → giữ TCP.
+_uds = os.getenv("BIND_UDS", "").strip()
+bind = f"unix:{_uds}" if _uds else f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# 1 worker: scheduler + WAITING_TASKS nằm trong RAM của process
+# → nhiều worker sẽ chạy job trùng và mất state nhập 3 việc.
+# Song song bằng pool thread cố định thay vì process / thread-per-request.
+# Webhook chỉ enqueue rồi trả 200 → không cần nhiều thread.
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", min(8, 2 * (os.cpu_count() or 1) + 1)))
+timeout = 60
+# > idle timeout của proxy Render → proxy giữ được kết nối keep-alive
+keepalive = 75
+
+
+def post_worker_init(worker):
+    """Worker sẵn sàng → set webhook + chạy scheduler"""
+    from ky_luat_bot import bootstrap
+    bootstrap()
@@ -2,15 +2,33 @@
 """
 🏋️ KỶ LUẬT 3 VIỆC/NGÀY — Telegram Bot + Notion
 Deploy: Render (Flask + APScheduler)
+Run:    gunicorn -c gunicorn_conf.py ky_luat_bot:app   (hoặc python ky_luat_bot.py)
 Env vars: TELEGRAM_TOKEN, NOTION_TOKEN, NOTION_DB_ID, CHAT_ID, WEBHOOK_URL
+          (tuỳ chọn) WEBHOOK_SECRET, TG_MAX_CONN, TG_POLLING
 """
 
 import os
-import json
+import re
+import sys
+import atexit
+import signal
+import hmac
+import logging
+import logging.handlers
+import time
 import datetime
+from zoneinfo import ZoneInfo
+import threading
+import queue
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+import orjson
 import requests
-import pytz
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, request
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerPool
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # ═══════════════════════════════════════════════════════════════
@@ -18,12 +36,37 @@ from apscheduler.schedulers.background import BackgroundScheduler
 # ═══════════════════════════════════════════════════════════════
 app = Flask(__name__)
 
+# Thread gọi log chỉ đẩy record vào queue; 1 thread listener ghi stdout
+_LOG_Q = queue.SimpleQueue()
+_log_out = logging.StreamHandler(sys.stdout)
+_log_out.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(message)s"))
+LOG_LISTENER = logging.handlers.QueueListener(_LOG_Q, _log_out, respect_handler_level=True)
+_log_in = logging.handlers.QueueHandler(_LOG_Q)
+_log_in.setFormatter(logging.Formatter("%(message)s"))  # format đầy đủ do _log_out lo
+logging.basicConfig(level=logging.INFO, handlers=[_log_in])
+LOG_LISTENER.start()
+log = logging.getLogger("ky_luat_bot")
+
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "").strip()
 NOTION_TOKEN = os.getenv("NOTION_TOKEN", "").strip()
 NOTION_DB_ID = os.getenv("NOTION_DB_ID", "").strip()
 CHAT_ID = os.getenv("CHAT_ID", "").strip()
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
-TZ = pytz.timezone("Asia/Ho_Chi_Minh")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()  # A-Z a-z 0-9 _ -
+TG_MAX_CONN = int(os.getenv("TG_MAX_CONN", "8"))
+PORT = int(os.getenv("PORT", "5000"))
+# 1 worker = update của chat xử lý đúng thứ tự (>1 thì 2 lần bấm nút có thể chạy chéo nhau)
+HANDLER_WORKERS = int(os.getenv("HANDLER_WORKERS", "1"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "100"))
+# Giây giữ kết quả query Notion (0 = tắt cache)
+NOTION_CACHE_TTL = float(os.getenv("NOTION_CACHE_TTL", "60"))
+# Bot chỉ xử lý 2 loại update này → Telegram khỏi gửi loại khác
+TG_ALLOWED_UPDATES = ["message", "callback_query"]
+# TG_POLLING=1 + không có WEBHOOK_URL → long polling getUpdates (chạy local).
+# Phải bật tay: polling gọi deleteWebhook → chạy thử bằng token thật sẽ gỡ webhook production
+TG_POLLING = os.getenv("TG_POLLING", "").strip() == "1"
+TG_POLL_TIMEOUT = 50  # giây Telegram giữ kết nối getUpdates
+TZ = ZoneInfo("Asia/Ho_Chi_Minh")  # resolve 1 lần, dùng chung cho job + scheduler
 
 # Notion property names (khớp DB của Sếp)
 P_TITLE = "Việc cần làm"
@@ -32,6 +75,9 @@ P_STATUS = "trạng thái"
 P_ORDER = "STT/ngày"
 P_STREAK = "Chuỗi"
 
+# Property bot thực sự đọc → chỉ xin Notion trả về các property này
+NOTION_READ_PROPS = (P_TITLE, P_DATE, P_STATUS, P_ORDER)
+
 # Status values
 S_DOING = "Đang làm"
 S_DONE = "Xong"
@@ -43,28 +89,205 @@ NOTION_HEADERS = {
     "Content-Type": "application/json",
 }
 
+# HTTP session (keep-alive, connection pool): 1 cho Notion, 1 cho Telegram
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def _retry(methods):
+    return Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=frozenset(methods),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+# (connect, read): host chết thì bỏ sau ~3s thay vì chờ hết read timeout
+NOTION_TIMEOUT = (3.05, 15)
+TG_TIMEOUT = (3.05, 10)
+
+# Header Notion gắn sẵn vào session → token Notion không bao giờ đi sang Telegram
+NOTION_SESSION = requests.Session()
+NOTION_SESSION.headers.update(NOTION_HEADERS)
+# Mặc định chỉ retry method idempotent (tạo page không được retry → tránh trùng)
+NOTION_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=20, max_retries=_retry({"GET", "PATCH"})))
+# /databases/... chỉ đọc (query là POST nhưng không ghi) → retry được cả POST
+NOTION_SESSION.mount(
+    "https://api.notion.com/v1/databases/",
+    HTTPAdapter(pool_connections=2, pool_maxsize=20, max_retries=_retry({"GET", "POST"})),
+)
+
+# Body gửi Telegram đã encode sẵn bằng orjson (bytes) → Content-Type gắn ở session
+# Gửi tin không retry tự động (429 xử lý tay trong _tg_post) → tránh gửi trùng
+TG_SESSION = requests.Session()
+TG_SESSION.headers["Content-Type"] = "application/json"
+TG_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=10, max_retries=_retry({"GET"})))
+
 # State: chờ Sếp nhập 3 việc
-WAITING_TASKS = {}  # {chat_id: True}
+WAITING_TASKS = set()  # {chat_id}; chỉ chứa CHAT_ID (chat khác bị lọc) → không phình
+
+# Webhook: ack ngay, xử lý update ở worker nền
+UPDATE_Q = queue.Queue(maxsize=UPDATE_QUEUE_MAX)
+_UPDATE_WORKERS = []
+_UPDATE_WORKERS_LOCK = threading.Lock()
+
+# Telegram có thể gửi lại cùng update_id (timeout/restart) → nhớ N id gần nhất để bỏ qua
+SEEN_UPDATES_MAX = 1000
+_SEEN_UPDATES = deque(maxlen=SEEN_UPDATES_MAX)
+_SEEN_UPDATES_SET = set()
+_SEEN_UPDATES_LOCK = threading.Lock()
+
+# Cache kết quả query Notion trong NOTION_CACHE_TTL giây, tối đa NOTION_CACHE_MAX key (LRU)
+NOTION_CACHE_MAX = 128
+_QCACHE = OrderedDict()  # {(max_pages, filter_json): (timestamp, results)}
+_QCACHE_LOCK = threading.Lock()
+_qcache_gen = 0  # tăng mỗi lần ghi → bỏ kết quả query cũ đang bay
+_QINFLIGHT = {}  # {(gen, max_pages, filter_json): Future} — query giống nhau đang chạy thì chờ chung
+
+# Trần số trang khi đi next_cursor (100 dòng/trang → tối đa 5000 dòng)
+NOTION_MAX_PAGES = 50
+
+# Schema DB (property name → {id, type, ...}); đổi theo tần suất sửa tay → cache 1h
+SCHEMA_TTL = 3600
+SCHEMA_RETRY = 60  # lỗi thì chờ 60s mới thử lại, khỏi GET mỗi lần query
+_DB_SCHEMA = {"ts": None, "ttl": SCHEMA_TTL, "properties": {}}
+_DB_SCHEMA_LOCK = threading.Lock()
+
+# Pool dùng chung cho các call Notion độc lập (I/O-bound)
+POOL = ThreadPoolExecutor(max_workers=5, thread_name_prefix="notion")
+
+# Mỗi job tối đa 1 instance → 4 job cần tối đa 4 thread (mặc định APScheduler là 10)
+SCHED_WORKERS = 4
+
+# Số ngày mỗi lần query khi tính streak (3 task/ngày → < 100 kết quả/trang)
+STREAK_WINDOW = 31
 
 # ═══════════════════════════════════════════════════════════════
 # NOTION HELPERS
 # ═══════════════════════════════════════════════════════════════
 
-def notion_query(filter_payload=None):
-    """Query Notion DB"""
+def notion_query(filter_payload=None, max_pages=NOTION_MAX_PAGES):
+    """Query Notion DB (có cache TTL ngắn, xoá khi ghi; query trùng đang chạy thì chờ chung)"""
+    # filter encode 1 lần: vừa làm key cache vừa ghép thẳng vào body gửi đi
+    filter_json = orjson.dumps(filter_payload, option=orjson.OPT_SORT_KEYS)
+    key = (max_pages, filter_json)
+    now = time.monotonic()
+    with _QCACHE_LOCK:
+        hit = _QCACHE.get(key)
+        if hit and now - hit[0] < NOTION_CACHE_TTL:
+            _QCACHE.move_to_end(key)
+            return list(hit[1])
+        gen = _qcache_gen
+        # Kèm gen: đọc sau khi ghi không chờ chung query bắt đầu trước lúc ghi
+        ikey = (gen,) + key
+        fut = _QINFLIGHT.get(ikey)
+        owner = fut is None
+        if owner:
+            fut = _QINFLIGHT[ikey] = Future()
+
+    if not owner:
+        return list(fut.result() or [])
+
+    results = None
+    try:
+        results = _notion_query_uncached(filter_json, max_pages)
+    finally:
+        with _QCACHE_LOCK:
+            _QINFLIGHT.pop(ikey, None)
+            if results is not None and gen == _qcache_gen and NOTION_CACHE_TTL > 0:
+                _QCACHE[key] = (now, results)
+                _QCACHE.move_to_end(key)
+                while len(_QCACHE) > NOTION_CACHE_MAX:
+                    _QCACHE.popitem(last=False)
+        fut.set_result(results)
+    return list(results or [])
+
+
+def notion_query_cached(filter_payload=None, max_pages=NOTION_MAX_PAGES):
+    """Chỉ đọc cache còn hạn của notion_query (không gọi Notion); None nếu chưa có"""
+    key = (max_pages, orjson.dumps(filter_payload, option=orjson.OPT_SORT_KEYS))
+    with _QCACHE_LOCK:
+        hit = _QCACHE.get(key)
+        if hit and time.monotonic() - hit[0] < NOTION_CACHE_TTL:
+            return list(hit[1])
+    return None
+
+
+def notion_cache_clear():
+    """Xoá cache query sau khi tạo/sửa page"""
+    global _qcache_gen
+    with _QCACHE_LOCK:
+        _QCACHE.clear()
+        _qcache_gen += 1
+
+
+def get_db_schema():
+    """Lấy schema DB (cache TTL trong process, lỗi thì dùng bản cũ)"""
+    with _DB_SCHEMA_LOCK:
+        ts = _DB_SCHEMA["ts"]
+        if ts is not None and time.monotonic() - ts < _DB_SCHEMA["ttl"]:
+            return _DB_SCHEMA["properties"]
+
+        url = f"https://api.notion.com/v1/databases/{NOTION_DB_ID}"
+        ttl = SCHEMA_RETRY
+        try:
+            r = NOTION_SESSION.get(url, timeout=NOTION_TIMEOUT)
+            if r.status_code == 200:
+                _DB_SCHEMA["properties"] = orjson.loads(r.content).get("properties", {})
+                ttl = SCHEMA_TTL
+            else:
+                log.error("[NOTION SCHEMA ERR] %s: %s", r.status_code, r.text[:300])
+        except (requests.RequestException, ValueError) as e:
+            log.error("[NOTION SCHEMA ERR] %s", e)
+        _DB_SCHEMA["ts"] = time.monotonic()
+        _DB_SCHEMA["ttl"] = ttl
+        return _DB_SCHEMA["properties"]
+
+
+def _filter_properties_qs():
+    """Query string filter_properties=<id>&... cho NOTION_READ_PROPS"""
+    schema = get_db_schema()
+    ids = [schema[name]["id"] for name in NOTION_READ_PROPS if schema.get(name, {}).get("id")]
+    # id từ Notion đã được URL-encode sẵn → ghép tay, không qua params=
+    return "&".join(f"filter_properties={pid}" for pid in ids)
+
+
+def _query_body(filter_json, cursor=None):
+    """Body JSON cho /query, ghép từ bytes filter đã encode sẵn (không dumps lại dict mỗi trang)"""
+    body = b'{"page_size":100'
+    if cursor:
+        body += b',"start_cursor":' + orjson.dumps(cursor)
+    if filter_json != b"null":
+        body += b',"filter":' + filter_json
+    return body + b"}"
+
+
+def _notion_query_uncached(filter_json=b"null", max_pages=NOTION_MAX_PAGES):
+    """Gọi thẳng Notion API (đi hết next_cursor), trả list TaskView hoặc None nếu lỗi"""
     url = f"https://api.notion.com/v1/databases/{NOTION_DB_ID}/query"
-    payload = {"page_size": 100}
-    if filter_payload:
-        payload["filter"] = filter_payload
+    qs = _filter_properties_qs()
+    if qs:
+        url = f"{url}?{qs}"
+    body = _query_body(filter_json)
+    results = []
     try:
-        r = requests.post(url, headers=NOTION_HEADERS, json=payload, timeout=15)
-        if r.status_code != 200:
-            print(f"[NOTION ERR] {r.status_code}: {r.text[:300]}")
-            return []
-        return r.json().get("results", [])
-    except Exception as e:
-        print(f"[NOTION ERR] {e}")
-        return []
+        for _ in range(max_pages):
+            r = NOTION_SESSION.post(url, data=body, timeout=NOTION_TIMEOUT)
+            if r.status_code != 200:
+                log.error("[NOTION ERR] %s: %s", r.status_code, r.text[:300])
+                return None
+            data = orjson.loads(r.content)
+            results.extend(map(TaskView, data.get("results", [])))
+            if not data.get("has_more") or not data.get("next_cursor"):
+                return results
+            body = _query_body(filter_json, data["next_cursor"])
+        log.warning("[NOTION WARN] Dừng ở %s trang (%s dòng)", max_pages, len(results))
+        return results
+    except (requests.RequestException, ValueError) as e:
+        log.error("[NOTION ERR] %s", e)
+        return None
 
 
 def notion_create(title, date_str, order, streak=0):
@@ -81,93 +304,134 @@ def notion_create(title, date_str, order, streak=0):
         },
     }
     try:
-        r = requests.post(url, headers=NOTION_HEADERS, json=payload, timeout=15)
+        r = NOTION_SESSION.post(url, data=orjson.dumps(payload), timeout=NOTION_TIMEOUT)
         return r.status_code == 200
-    except Exception as e:
-        print(f"[NOTION CREATE ERR] {e}")
+    except requests.RequestException as e:
+        log.error("[NOTION CREATE ERR] %s", e)
         return False
+    finally:
+        notion_cache_clear()
 
 
 def notion_update(page_id, props):
     """Update properties của 1 page"""
     url = f"https://api.notion.com/v1/pages/{page_id}"
     try:
-        r = requests.patch(url, headers=NOTION_HEADERS, json={"properties": props}, timeout=15)
+        r = NOTION_SESSION.patch(url, data=orjson.dumps({"properties": props}), timeout=NOTION_TIMEOUT)
         return r.status_code == 200
-    except Exception as e:
-        print(f"[NOTION UPDATE ERR] {e}")
+    except requests.RequestException as e:
+        log.error("[NOTION UPDATE ERR] %s", e)
         return False
+    finally:
+        notion_cache_clear()
 
 
-def get_title(page):
-    """Lấy title từ page"""
-    prop = page.get("properties", {}).get(P_TITLE, {})
-    titles = prop.get("title", [])
-    return "".join(t.get("plain_text", "") for t in titles).strip() or "—"
+class TaskView:
+    """1 task Notion đã đọc sẵn properties (tạo 1 lần lúc nhận kết quả query)"""
 
+    __slots__ = ("id", "date", "order", "title", "status")
 
-def get_status(page):
-    sel = page.get("properties", {}).get(P_STATUS, {}).get("select")
-    return sel.get("name", "") if sel else ""
+    def __init__(self, page):
+        props = page.get("properties") or {}
+        titles = (props.get(P_TITLE) or {}).get("title") or []
+        sel = (props.get(P_STATUS) or {}).get("select")
+        date = (props.get(P_DATE) or {}).get("date") or {}
+        self.id = page.get("id", "")
+        self.date = (date.get("start") or "")[:10]  # YYYY-MM-DD
+        self.order = (props.get(P_ORDER) or {}).get("number") or 0
+        self.title = "".join(t.get("plain_text", "") for t in titles).strip() or "—"
+        self.status = sel.get("name", "") if sel else ""
 
 
-def get_order(page):
-    return page.get("properties", {}).get(P_ORDER, {}).get("number") or 0
+def _task_order(task):
+    return task.order
 
 
-def today_str():
-    return datetime.datetime.now(TZ).strftime("%Y-%m-%d")
+def today_date():
+    return datetime.datetime.now(TZ).date()
 
 
-def get_today_tasks():
-    """Lấy 3 task hôm nay, sorted by order"""
-    pages = notion_query({
-        "property": P_DATE,
-        "date": {"equals": today_str()}
-    })
-    pages.sort(key=lambda p: get_order(p))
+def date_filter(op, date_str):
+    """Điều kiện lọc theo cột Ngày — nơi duy nhất dựng filter ngày"""
+    return {"property": P_DATE, "date": {op: date_str}}
+
+
+def get_tasks_on(date_str):
+    """Lấy tasks của 1 ngày, sorted by order"""
+    # 1 ngày chỉ vài task → 1 trang (100 dòng) là đủ, khỏi đi cursor
+    pages = notion_query(date_filter("equals", date_str), max_pages=1)
+    pages.sort(key=_task_order)
     return pages
 
 
+def peek_tasks_on(date_str):
+    """Tasks của 1 ngày nếu còn trong cache (không gọi Notion), None nếu không có"""
+    return notion_query_cached(date_filter("equals", date_str), max_pages=1)
+
+
+def tasks_on(pages, date_str):
+    """Lọc tasks của 1 ngày từ list đã fetch, sorted by order"""
+    return sorted((p for p in pages if p.date == date_str), key=_task_order)
+
+
+def get_today_tasks(today=None):
+    """Lấy 3 task hôm nay, sorted by order"""
+    return get_tasks_on((today or today_date()).isoformat())
+
+
 def get_tasks_range(start_date, end_date):
     """Lấy tasks trong khoảng ngày"""
     return notion_query({
         "and": [
-            {"property": P_DATE, "date": {"on_or_after": start_date}},
-            {"property": P_DATE, "date": {"on_or_before": end_date}},
+            date_filter("on_or_after", start_date),
+            date_filter("on_or_before", end_date),
         ]
     })
 
 
+def get_recent_tasks(today):
+    """1 query từ (today - STREAK_WINDOW) tới hết today: đủ cho cửa sổ streak đầu + hôm nay/tuần này"""
+    start = today - datetime.timedelta(days=STREAK_WINDOW)
+    return get_tasks_range(start.isoformat(), today.isoformat())
+
+
 # ═══════════════════════════════════════════════════════════════
 # STREAK LOGIC
 # ═══════════════════════════════════════════════════════════════
 
-def calculate_current_streak():
+def calculate_current_streak(today=None, recent=None):
     """
     Đếm streak: bao nhiêu ngày liên tiếp (tính từ hôm qua trở về trước)
     mà cả 3 task đều Xong.
+    Query theo cửa sổ STREAK_WINDOW ngày rồi gom theo ngày,
+    thay vì 1 query cho mỗi ngày.
+    recent: kết quả get_recent_tasks(today) nếu caller đã có → bỏ query cửa sổ đầu.
     """
-    today = datetime.datetime.now(TZ).date()
+    today = today or today_date()
     streak = 0
     check_date = today - datetime.timedelta(days=1)
+    oldest = today - datetime.timedelta(days=365)  # max 1 năm
 
-    for _ in range(365):  # max 1 năm
-        date_str = check_date.strftime("%Y-%m-%d")
-        tasks = notion_query({
-            "property": P_DATE,
-            "date": {"equals": date_str}
-        })
-
-        if len(tasks) == 0:
-            break  # ngày không có task → dừng
-
-        all_done = all(get_status(t) == S_DONE for t in tasks) and len(tasks) >= 3
-        if all_done:
+    while check_date >= oldest:
+        window_start = max(check_date - datetime.timedelta(days=STREAK_WINDOW - 1), oldest)
+        if recent is not None:
+            rows, recent = recent, None
+        else:
+            rows = get_tasks_range(window_start.isoformat(), check_date.isoformat())
+        by_date = defaultdict(list)
+        for t in rows:
+            by_date[t.date].append(t)
+
+        while check_date >= window_start:
+            tasks = by_date.get(check_date.isoformat(), [])
+            if len(tasks) == 0:
+                return streak  # ngày không có task → dừng
+
+            all_done = all(t.status == S_DONE for t in tasks) and len(tasks) >= 3
+            if not all_done:
+                return streak
             streak += 1
             check_date -= datetime.timedelta(days=1)
-        else:
-            break
 
     return streak
 
@@ -176,39 +440,224 @@ def calculate_current_streak():
 # TELEGRAM HELPERS
 # ═══════════════════════════════════════════════════════════════
 
+class TokenBucket:
+    """Token bucket thread-safe: rate token/giây, tối đa capacity token"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+                self.ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Giới hạn Telegram: ~30 tin/giây toàn bot, ~1 tin/giây mỗi chat
+TG_GLOBAL_BUCKET = TokenBucket(rate=25, capacity=25)
+TG_CHAT_INTERVAL = 1.05
+_TG_CHAT_BUCKETS = defaultdict(lambda: TokenBucket(rate=1 / TG_CHAT_INTERVAL, capacity=1))
+_TG_CHAT_LOCK = threading.Lock()
+
+
+def _tg_throttle(cid):
+    """Chờ tới khi được phép gửi tin cho chat cid"""
+    with _TG_CHAT_LOCK:
+        bucket = _TG_CHAT_BUCKETS[str(cid)]
+    bucket.acquire()
+    TG_GLOBAL_BUCKET.acquire()
+
+
+# Hàng đợi gửi tin: request/job chỉ enqueue, 1 worker gửi tuần tự (giữ thứ tự + rate limit).
+# Có giới hạn → nếu Telegram nghẽn thì người gửi chờ (backpressure) thay vì phình RAM.
+TG_OUT_Q = queue.Queue(maxsize=500)
+_TG_WORKER = None
+_TG_WORKER_LOCK = threading.Lock()
+
+
+def _ensure_tg_worker():
+    """Start worker gửi tin (lazy → an toàn khi gunicorn fork)"""
+    global _TG_WORKER
+    with _TG_WORKER_LOCK:
+        if _TG_WORKER is None or not _TG_WORKER.is_alive():
+            _TG_WORKER = threading.Thread(target=_tg_worker, name="tg-sender", daemon=True)
+            _TG_WORKER.start()
+
+
+def _tg_worker():
+    while True:
+        payload = TG_OUT_Q.get()
+        try:
+            _tg_post(payload)
+        except Exception:
+            log.exception("[TG ERR] worker")
+        finally:
+            TG_OUT_Q.task_done()
+
+
+# Telegram giới hạn 4096 ký tự/tin; chừa chỗ cho emoji (2 code unit) + thẻ HTML
+TG_MAX_LEN = 4000
+# Chừa cuối mỗi phần cho thẻ đóng thêm vào khi cắt ngang 1 cặp thẻ (</b></i>...)
+TG_TAG_RESERVE = 32
+# Field cố định của mọi sendMessage
+_TG_SEND_DEFAULTS = {"parse_mode": "HTML", "disable_web_page_preview": True}
+# Thẻ HTML mở/đóng: <b>, </b>, <a href="...">, <pre>...
+_HTML_TAG_RE = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>")
+
+
+def _open_tags(html):
+    """Các thẻ còn mở ở cuối đoạn html, theo thứ tự mở: [(tên, thẻ mở gốc)]"""
+    stack = []
+    for m in _HTML_TAG_RE.finditer(html):
+        name = m.group(2).lower()
+        if not m.group(1):
+            stack.append((name, m.group(0)))
+            continue
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                del stack[i:]
+                break
+    return stack
+
+
+def _safe_cut(text, cut, reopen):
+    """Lùi chỗ cắt ra khỏi thẻ HTML; -1 nếu phần cắt ra không còn nội dung (chỉ toàn thẻ mở)"""
+    # Không cắt giữa thẻ (khoảng trắng trong <a href="..."> cũng tính)
+    tag = text.rfind("<", 0, cut)
+    if tag > text.rfind(">", 0, cut):
+        cut = tag
+    # Không kết thúc phần bằng thẻ mở (→ cặp thẻ rỗng <b></b>)
+    while text[cut - 1:cut] == ">":
+        tag = text.rfind("<", 0, cut)
+        if text[tag + 1:tag + 2] == "/":
+            break
+        cut = tag
+    return cut if cut > reopen else -1
+
+
+def _cut_point(text, floor, end, reopen):
+    """Chỗ cắt trong text[:end]: xuống dòng → khoảng trắng → cắt cứng; không rơi giữa thẻ/entity"""
+    # Xuống dòng/khoảng trắng phải ở nửa sau (floor) → không sinh phần quá ngắn;
+    # không có thì cắt cứng (vẫn có chặn thẻ/entity) thay vì lùi về chỗ trống quá sớm
+    cut = text.rfind("\n", floor, end)
+    if cut < 0:
+        cut = text.rfind(" ", max(floor, reopen + 1), end)
+    if cut > 0:
+        cut = _safe_cut(text, cut, reopen)
+    if cut > 0:
+        return cut
+
+    cut = end
+    amp = text.rfind("&", 0, cut)
+    if amp > reopen and cut - amp < 12 and amp > text.rfind(";", 0, cut):
+        cut = amp  # không cắt giữa &amp; &#...;
+    cut = _safe_cut(text, cut, reopen)
+    # Không còn chỗ lùi (thẻ dài hơn cả tin) → cắt cứng cho chắc tiến được
+    return cut if cut > 0 else max(end, reopen + 1)
+
+
+def _has_text(html):
+    """Còn chữ sau khi bỏ thẻ + khoảng trắng (Telegram trả 400 cho tin rỗng)"""
+    return bool(_HTML_TAG_RE.sub("", html).strip())
+
+
+def _split_message(text, limit=TG_MAX_LEN):
+    """
+    Cắt tin dài thành các phần ≤ limit: ưu tiên xuống dòng, rồi khoảng trắng.
+    Không cắt giữa thẻ/entity HTML; thẻ còn mở thì đóng ở cuối phần và mở lại ở phần sau
+    → phần nào cũng là HTML hợp lệ (parse_mode=HTML không nhận thẻ lệch).
+    """
+    room = limit - min(TG_TAG_RESERVE, limit // 4)
+    floor = room // 2
+    reopen = 0  # độ dài các thẻ mở lại ở đầu text
+    while len(text) > limit:
+        end = room
+        while True:
+            cut = _cut_point(text, floor, end, reopen)
+            head, rest = text[:cut], text[cut:]
+            opened = _open_tags(head)
+            # Thẻ đóng nằm ngay sau chỗ cắt → kéo luôn vào phần này, khỏi đóng/mở lại
+            while opened and rest.startswith(f"</{opened[-1][0]}>"):
+                n = len(opened.pop()[0]) + 3
+                head, rest = head + rest[:n], rest[n:]
+            close = "".join(f"</{name}>" for name, _ in reversed(opened))
+            over = len(head) + len(close) - limit
+            # Thẻ đóng vượt phần chừa sẵn (lồng nhiều thẻ) → lùi chỗ cắt rồi thử lại
+            if over <= 0 or end <= reopen + 1:
+                break
+            end = max(end - over, reopen + 1)
+        if rest[:1] in ("\n", " "):
+            rest = rest[1:]
+        prefix = "".join(tag for _, tag in opened)
+        text = prefix + rest
+        reopen = len(prefix)
+        if _has_text(head):
+            yield head + close
+    if _has_text(text):
+        yield text
+
+
 def tg_send(text, chat_id=None, reply_markup=None):
-    """Gửi tin nhắn Telegram"""
+    """Gửi tin nhắn Telegram (đưa vào hàng đợi, không chặn request/job)"""
     cid = chat_id or CHAT_ID
     if not TELEGRAM_TOKEN or not cid:
-        print(f"[TG OFF] {text}")
+        log.info("[TG OFF] %s", text)
         return
+    _ensure_tg_worker()
+    # Đa số tin < TG_MAX_LEN → 1 phần, khỏi chạy bộ cắt
+    parts = (text,) if len(text) <= TG_MAX_LEN else list(_split_message(text))
+    for i, part in enumerate(parts, 1):
+        payload = {**_TG_SEND_DEFAULTS, "chat_id": cid, "text": part}
+        # Tin dài chỉ báo 1 lần: phần 2..N gửi im lặng
+        if i > 1:
+            payload["disable_notification"] = True
+        # Nút bấm gắn vào phần cuối
+        if reply_markup and i == len(parts):
+            payload["reply_markup"] = reply_markup
+        TG_OUT_Q.put(payload)
+
+
+def _tg_post(payload):
+    """Gọi sendMessage (có rate limit + tôn trọng retry_after khi 429)"""
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": cid,
-        "text": text,
-        "parse_mode": "HTML",
-        "disable_web_page_preview": True,
-    }
-    if reply_markup:
-        payload["reply_markup"] = json.dumps(reply_markup)
-    try:
-        requests.post(url, json=payload, timeout=10)
-    except Exception as e:
-        print(f"[TG ERR] {e}")
+    for _ in range(3):
+        _tg_throttle(payload["chat_id"])
+        try:
+            r = TG_SESSION.post(url, data=orjson.dumps(payload), timeout=TG_TIMEOUT)
+        except requests.RequestException as e:
+            log.warning("[TG ERR] %s", e)
+            return
+        if r.status_code != 429:
+            if r.status_code != 200:
+                # Gửi ở worker nền → không log thì tin bị Telegram từ chối (400, quá dài...) mất dấu
+                log.warning("[TG ERR] %s: %s", r.status_code, r.text[:200])
+            return
+        try:
+            retry_after = orjson.loads(r.content).get("parameters", {}).get("retry_after", 1)
+        except orjson.JSONDecodeError:
+            retry_after = 1
+        log.warning("[TG 429] retry sau %ss", retry_after)
+        time.sleep(retry_after)
 
 
 def build_review_keyboard(tasks):
     """Tạo inline keyboard cho review tối"""
     buttons = []
     for t in tasks:
-        order = get_order(t)
-        title = get_title(t)
-        status = get_status(t)
-        if status != S_DONE:
-            emoji = "☐"
+        if t.status != S_DONE:
             buttons.append([{
-                "text": f"✅ {order}. {title}",
-                "callback_data": f"done:{t['id']}"
+                "text": f"✅ {t.order}. {t.title}",
+                "callback_data": f"done:{t.id}"
             }])
         # Nếu đã done thì không tạo nút
     return {"inline_keyboard": buttons} if buttons else None
@@ -220,10 +669,12 @@ def build_review_keyboard(tasks):
 
 def job_morning():
     """9:00 — Hỏi 3 việc"""
-    print(f"[JOB] morning {datetime.datetime.now(TZ)}")
+    now = datetime.datetime.now(TZ)
+    today = now.date()
+    log.info("[JOB] morning %s", now)
 
     # Check đã có task hôm nay chưa
-    existing = get_today_tasks()
+    existing = get_today_tasks(today)
     if len(existing) >= 3:
         tg_send(
             "🌅 <b>Sếp ơi, hôm nay đã có 3 việc rồi!</b>\n\n"
@@ -232,7 +683,7 @@ def job_morning():
         )
         return
 
-    WAITING_TASKS[CHAT_ID] = True
+    WAITING_TASKS.add(CHAT_ID)
     tg_send(
         "🌅 <b>Chào buổi sáng Sếp!</b>\n\n"
         "📝 Hôm nay 3 việc quan trọng nhất là gì?\n"
@@ -242,17 +693,19 @@ def job_morning():
 
 def job_evening():
     """21:00 — Review cuối ngày"""
-    print(f"[JOB] evening {datetime.datetime.now(TZ)}")
+    now = datetime.datetime.now(TZ)
+    today = now.date()
+    log.info("[JOB] evening %s", now)
 
-    tasks = get_today_tasks()
+    tasks = get_today_tasks(today)
     if not tasks:
         tg_send("🌙 Hôm nay chưa có việc nào được ghi nhận 😶")
         return
 
-    done_count = sum(1 for t in tasks if get_status(t) == S_DONE)
+    done_count = sum(1 for t in tasks if t.status == S_DONE)
 
     if done_count >= 3:
-        streak = calculate_current_streak()
+        streak = calculate_current_streak(today)
         tg_send(
             "🌙 <b>Review cuối ngày</b>\n\n"
             + format_task_list(tasks)
@@ -274,36 +727,40 @@ def job_evening():
 
 def job_midnight():
     """0:00 — Xử lý trễ hạn + tính streak"""
-    print(f"[JOB] midnight {datetime.datetime.now(TZ)}")
+    now = datetime.datetime.now(TZ)
+    today = now.date()
+    log.info("[JOB] midnight %s", now)
 
     # Lấy task của NGÀY HÔM QUA (vì đã sang ngày mới)
-    yesterday = (datetime.datetime.now(TZ) - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-    tasks = notion_query({
-        "property": P_DATE,
-        "date": {"equals": yesterday}
-    })
+    yesterday = (today - datetime.timedelta(days=1)).isoformat()
+    # 1 query dùng chung cho task hôm qua + cửa sổ streak
+    recent = get_recent_tasks(today)
+    tasks = tasks_on(recent, yesterday)
 
     if not tasks:
         return
 
+    # Đang làm hay Trễ hạn đều "chưa xong" → tính streak trước khi đổi trạng thái vẫn đúng
+    streak = calculate_current_streak(today, recent)
+
     overdue_list = []
     done_count = 0
+    # Mỗi task đúng 1 PATCH (streak + trạng thái gộp chung), chạy song song trên POOL
+    futures = []
 
     for t in tasks:
-        if get_status(t) == S_DOING:
+        props = {P_STREAK: {"number": streak}}
+        status = t.status
+        if status == S_DOING:
             # Chuyển thành Trễ hạn
-            notion_update(t["id"], {
-                P_STATUS: {"select": {"name": S_OVERDUE}}
-            })
-            overdue_list.append(get_title(t))
-        elif get_status(t) == S_DONE:
+            props[P_STATUS] = {"select": {"name": S_OVERDUE}}
+            overdue_list.append(t.title)
+        elif status == S_DONE:
             done_count += 1
+        futures.append(POOL.submit(notion_update, t.id, props))
 
-    streak = calculate_current_streak()
-
-    # Update streak vào tất cả task hôm qua
-    for t in tasks:
-        notion_update(t["id"], {P_STREAK: {"number": streak}})
+    for f in futures:
+        f.result()
 
     # Gửi báo cáo
     if overdue_list:
@@ -325,50 +782,45 @@ def job_midnight():
 
 def job_weekly():
     """Chủ nhật 20:00 — Báo cáo tuần"""
-    print(f"[JOB] weekly {datetime.datetime.now(TZ)}")
+    now = datetime.datetime.now(TZ)
+    today = now.date()
+    log.info("[JOB] weekly %s", now)
 
-    today = datetime.datetime.now(TZ).date()
     week_start = today - datetime.timedelta(days=6)
-    start_str = week_start.strftime("%Y-%m-%d")
-    end_str = today.strftime("%Y-%m-%d")
+    start_str = week_start.isoformat()
+    end_str = today.isoformat()
+
+    # Tuần này nằm trong cửa sổ streak → 1 query cho cả hai
+    recent = get_recent_tasks(today)
+    tasks = [t for t in recent if start_str <= t.date <= end_str]
 
-    tasks = get_tasks_range(start_str, end_str)
+    # 1 vòng: đếm theo trạng thái + gom theo ngày [tổng, xong]
+    by_status = Counter()
+    by_date = defaultdict(lambda: [0, 0])
+    for t in tasks:
+        status = t.status
+        by_status[status] += 1
+        day = by_date[t.date]
+        day[0] += 1
+        day[1] += status == S_DONE
 
     total = len(tasks)
-    done = sum(1 for t in tasks if get_status(t) == S_DONE)
-    overdue = sum(1 for t in tasks if get_status(t) == S_OVERDUE)
-    doing = sum(1 for t in tasks if get_status(t) == S_DOING)
+    done = by_status[S_DONE]
+    overdue = by_status[S_OVERDUE]
 
     pct = (done / total * 100) if total > 0 else 0
-    streak = calculate_current_streak()
+    streak = calculate_current_streak(today, recent)
 
     # Tính số ngày perfect (3/3)
-    perfect_days = 0
-    for i in range(7):
-        d = (week_start + datetime.timedelta(days=i)).strftime("%Y-%m-%d")
-        day_tasks = [t for t in tasks if t.get("properties", {}).get(P_DATE, {}).get("date", {}).get("start") == d]
-        if len(day_tasks) >= 3 and all(get_status(t) == S_DONE for t in day_tasks):
-            perfect_days += 1
+    perfect_days = sum(1 for n, n_done in by_date.values() if n >= 3 and n_done == n)
 
     # Emoji rating
-    if pct >= 90:
-        rating = "🏆 XUẤT SẮC!"
-    elif pct >= 70:
-        rating = "💪 KHÁ TỐT!"
-    elif pct >= 50:
-        rating = "😤 CỐ LÊN!"
-    else:
-        rating = "😰 NGUY HIỂM!"
-
-    # Progress bar
-    bar_len = 14
-    filled = int(round(bar_len * pct / 100))
-    bar = "█" * filled + "░" * (bar_len - filled)
+    rating = next(r for n, r in _WEEK_RATING if pct >= n)
 
     tg_send(
         f"📊 <b>BÁO CÁO TUẦN</b>\n"
         f"📅 {week_start.strftime('%d/%m')} → {today.strftime('%d/%m')}\n\n"
-        f"[{bar}] {pct:.0f}%\n\n"
+        f"{render_progress_bar(pct)}\n\n"
         f"✅ Hoàn thành: <b>{done}/{total}</b> task\n"
         f"❌ Trễ hạn: {overdue} task\n"
         f"⭐ Ngày perfect: {perfect_days}/7\n"
@@ -383,22 +835,26 @@ def job_weekly():
 # FORMAT HELPERS
 # ═══════════════════════════════════════════════════════════════
 
+BAR_LEN = 14
+_STATUS_ICON = {S_DONE: "✅", S_OVERDUE: "❌"}  # còn lại (Đang làm) → ⬜
+# (ngưỡng, emoji) giảm dần, dòng cuối là mặc định
+_STREAK_EMOJI = ((7, "🏆"), (3, "🔥"), (1, "⭐"), (0, "💤"))
+_WEEK_RATING = ((90, "🏆 XUẤT SẮC!"), (70, "💪 KHÁ TỐT!"), (50, "😤 CỐ LÊN!"), (0, "😰 NGUY HIỂM!"))
+_BARS = tuple("█" * i + "░" * (BAR_LEN - i) for i in range(BAR_LEN + 1))
+
+
+def render_progress_bar(pct):
+    """[███░░] 42% — bar dựng sẵn, chỉ tra theo số ô"""
+    pct = max(0, min(100, pct or 0))
+    return f"[{_BARS[int(round(BAR_LEN * pct / 100))]}] {pct:.0f}%"
+
+
 def format_task_list(tasks):
     """Format danh sách task đẹp"""
     lines = []
     for t in tasks:
-        order = get_order(t)
-        title = get_title(t)
-        status = get_status(t)
-
-        if status == S_DONE:
-            icon = "✅"
-        elif status == S_OVERDUE:
-            icon = "❌"
-        else:
-            icon = "⬜"
-
-        lines.append(f"  {icon} {order}. {title}")
+        icon = _STATUS_ICON.get(t.status, "⬜")
+        lines.append(f"  {icon} {t.order}. {t.title}")
     return "\n".join(lines)
 
 
@@ -406,14 +862,102 @@ def format_task_list(tasks):
 # TELEGRAM WEBHOOK HANDLER
 # ═══════════════════════════════════════════════════════════════
 
+_OK_BODY = orjson.dumps({"ok": True})
+
+
+def ok():
+    """Response {"ok": true} dựng sẵn bytes"""
+    return app.response_class(_OK_BODY, mimetype="application/json"), 200
+
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    data = request.get_json(silent=True) or {}
+    """Trả 200 ngay cho Telegram, update xử lý ở worker nền"""
+    # So sánh hằng thời gian; bytes để header lạ (non-ASCII) không làm compare_digest raise
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), WEBHOOK_SECRET.encode()
+    ):
+        return app.response_class(status=403)
+    try:
+        data = orjson.loads(request.get_data(cache=False)) or {}
+    except orjson.JSONDecodeError:
+        data = {}
+    if not isinstance(data, dict) or not data:
+        return ok()
+
+    update_id = data.get("update_id")
+    if not _mark_update_seen(update_id):
+        log.info("[WEBHOOK] Bỏ qua update trùng %s", update_id)
+        return ok()
+
+    _ensure_update_workers()
+    try:
+        UPDATE_Q.put_nowait(data)
+    except queue.Full:
+        # Telegram sẽ gửi lại sau → không phình RAM
+        _unmark_update_seen(update_id)
+        log.warning("[WEBHOOK] Hàng đợi đầy, trả 429")
+        return app.response_class(status=429)
+    return ok()
+
+
+def _mark_update_seen(update_id):
+    """True nếu update_id mới (và ghi nhớ nó), False nếu đã nhận rồi"""
+    if update_id is None:
+        return True
+    with _SEEN_UPDATES_LOCK:
+        if update_id in _SEEN_UPDATES_SET:
+            return False
+        if len(_SEEN_UPDATES) == SEEN_UPDATES_MAX:
+            _SEEN_UPDATES_SET.discard(_SEEN_UPDATES[0])
+        _SEEN_UPDATES.append(update_id)
+        _SEEN_UPDATES_SET.add(update_id)
+        return True
+
+
+def _unmark_update_seen(update_id):
+    """Quên update_id (enqueue thất bại) → lần Telegram gửi lại vẫn được xử lý"""
+    if update_id is None:
+        return
+    with _SEEN_UPDATES_LOCK:
+        _SEEN_UPDATES_SET.discard(update_id)
+        try:
+            _SEEN_UPDATES.remove(update_id)
+        except ValueError:
+            pass
+
+
+def _ensure_update_workers():
+    """Start worker xử lý update (lazy → an toàn khi gunicorn fork)"""
+    with _UPDATE_WORKERS_LOCK:
+        _UPDATE_WORKERS[:] = [t for t in _UPDATE_WORKERS if t.is_alive()]
+        for i in range(len(_UPDATE_WORKERS), HANDLER_WORKERS):
+            t = threading.Thread(target=_update_worker, name=f"tg-update-{i}", daemon=True)
+            t.start()
+            _UPDATE_WORKERS.append(t)
+
+
+def _update_worker():
+    while True:
+        data = UPDATE_Q.get()
+        try:
+            handle_update(data)
+        except Exception:
+            log.exception("[UPDATE ERR]")
+        finally:
+            UPDATE_Q.task_done()
+
+
+def handle_update(data):
+    """Xử lý 1 update Telegram (chạy trên worker)"""
+    # Đọc đồng hồ 1 lần cho cả update, truyền xuống handler
+    today = today_date()
 
     # ── Callback query (nút bấm) ──
     callback = data.get("callback_query")
     if callback:
-        return handle_callback(callback)
+        handle_callback(callback, today)
+        return
 
     # ── Text message ──
     msg = data.get("message", {})
@@ -421,134 +965,29 @@ def webhook():
     chat_id = str(msg.get("chat", {}).get("id", ""))
 
     if not text or not chat_id:
-        return jsonify({"ok": True}), 200
+        return
 
     # Chỉ xử lý từ Sếp
     if chat_id != CHAT_ID:
-        return jsonify({"ok": True}), 200
+        return
 
     # ── Commands ──
     cmd = text.lower()
 
-    if cmd == "/start":
-        tg_send(
-            "🏋️ <b>Bot Kỷ Luật 3 Việc/Ngày</b>\n\n"
-            "📌 Mỗi sáng 9h → gửi 3 việc\n"
-            "📌 Mỗi tối 21h → review kết quả\n"
-            "📌 0h → chốt ngày, tính streak\n"
-            "📌 CN 20h → báo cáo tuần\n\n"
-            "Lệnh:\n"
-            "  /status — Xem 3 việc hôm nay\n"
-            "  /streak — Xem streak\n"
-            "  /done 1 — Đánh dấu xong việc 1\n"
-            "  /add — Nhập 3 việc thủ công\n\n"
-            "🔥 <i>Kỷ luật tạo tự do!</i>",
-            chat_id
-        )
-        return jsonify({"ok": True}), 200
-
-    if cmd == "/status":
-        tasks = get_today_tasks()
-        if not tasks:
-            tg_send("📋 Hôm nay chưa có việc nào.\nGửi /add để nhập 3 việc!", chat_id)
-        else:
-            done_count = sum(1 for t in tasks if get_status(t) == S_DONE)
-            streak = calculate_current_streak()
-            tg_send(
-                f"📋 <b>3 việc hôm nay</b>\n\n"
-                + format_task_list(tasks)
-                + f"\n\n📊 {done_count}/3 | 🔥 Streak: {streak}",
-                chat_id
-            )
-        return jsonify({"ok": True}), 200
-
-    if cmd == "/streak":
-        streak = calculate_current_streak()
-        # Check hôm nay nếu đã xong hết thì +1
-        today_tasks = get_today_tasks()
-        today_done = len(today_tasks) >= 3 and all(get_status(t) == S_DONE for t in today_tasks)
-        display_streak = streak + 1 if today_done else streak
-
-        if display_streak >= 7:
-            emoji = "🏆"
-        elif display_streak >= 3:
-            emoji = "🔥"
-        elif display_streak >= 1:
-            emoji = "⭐"
-        else:
-            emoji = "💤"
-
-        tg_send(
-            f"{emoji} <b>STREAK: {display_streak} ngày</b>\n\n"
-            + ("Giữ lửa nha Sếp! 💪" if display_streak > 0 else "Bắt đầu lại từ hôm nay! 🚀"),
-            chat_id
-        )
-        return jsonify({"ok": True}), 200
+    handler = COMMANDS.get(cmd)
+    if handler:
+        handler(chat_id, today)
+        return
 
     if cmd.startswith("/done"):
-        parts = cmd.split()
-        if len(parts) < 2 or not parts[1].isdigit():
-            tg_send("⚠️ Dùng: /done 1 hoặc /done 2 hoặc /done 3", chat_id)
-            return jsonify({"ok": True}), 200
-
-        num = int(parts[1])
-        if num < 1 or num > 3:
-            tg_send("⚠️ Chỉ có việc 1, 2, 3 thôi Sếp!", chat_id)
-            return jsonify({"ok": True}), 200
-
-        tasks = get_today_tasks()
-        target = None
-        for t in tasks:
-            if get_order(t) == num:
-                target = t
-                break
-
-        if not target:
-            tg_send(f"⚠️ Không tìm thấy việc số {num} hôm nay.", chat_id)
-            return jsonify({"ok": True}), 200
-
-        if get_status(target) == S_DONE:
-            tg_send(f"✅ Việc {num} đã xong rồi!", chat_id)
-            return jsonify({"ok": True}), 200
-
-        notion_update(target["id"], {P_STATUS: {"select": {"name": S_DONE}}})
-        title = get_title(target)
-
-        # Check 3/3 chưa
-        done_count = sum(1 for t in tasks if get_status(t) == S_DONE) + 1
-        if done_count >= 3:
-            streak = calculate_current_streak()
-            tg_send(
-                f"✅ <b>Xong: {title}</b>\n\n"
-                f"🎉 PERFECT DAY! 3/3 hoàn thành!\n"
-                f"🔥 Streak: {streak + 1} ngày!",
-                chat_id
-            )
-        else:
-            tg_send(
-                f"✅ <b>Xong: {title}</b>\n"
-                f"📊 Tiến độ: {done_count}/3",
-                chat_id
-            )
-        return jsonify({"ok": True}), 200
-
-    if cmd == "/add":
-        existing = get_today_tasks()
-        if len(existing) >= 3:
-            tg_send(
-                "⚠️ Hôm nay đã có 3 việc rồi!\n\n"
-                + format_task_list(existing),
-                chat_id
-            )
-            return jsonify({"ok": True}), 200
-
-        WAITING_TASKS[chat_id] = True
-        tg_send("📝 Gửi 3 dòng, mỗi dòng 1 việc 👇", chat_id)
-        return jsonify({"ok": True}), 200
+        m = CMD_DONE_RE.fullmatch(cmd)
+        cmd_done(chat_id, today, m.group(1) if m else None)
+        return
 
     # ── Đang chờ nhập 3 việc ──
-    if WAITING_TASKS.get(chat_id):
-        return handle_task_input(text, chat_id)
+    if chat_id in WAITING_TASKS:
+        handle_task_input(text, chat_id, today)
+        return
 
     # ── Không nhận diện ──
     tg_send(
@@ -559,12 +998,138 @@ def webhook():
         "  /add — Nhập 3 việc",
         chat_id
     )
-    return jsonify({"ok": True}), 200
 
 
-def handle_task_input(text, chat_id):
+def cmd_start(chat_id, today):
+    tg_send(
+        "🏋️ <b>Bot Kỷ Luật 3 Việc/Ngày</b>\n\n"
+        "📌 Mỗi sáng 9h → gửi 3 việc\n"
+        "📌 Mỗi tối 21h → review kết quả\n"
+        "📌 0h → chốt ngày, tính streak\n"
+        "📌 CN 20h → báo cáo tuần\n\n"
+        "Lệnh:\n"
+        "  /status — Xem 3 việc hôm nay\n"
+        "  /streak — Xem streak\n"
+        "  /done 1 — Đánh dấu xong việc 1\n"
+        "  /add — Nhập 3 việc thủ công\n\n"
+        "🔥 <i>Kỷ luật tạo tự do!</i>",
+        chat_id
+    )
+
+
+def cmd_status(chat_id, today):
+    recent = get_recent_tasks(today)
+    tasks = tasks_on(recent, today.isoformat())
+    if not tasks:
+        tg_send("📋 Hôm nay chưa có việc nào.\nGửi /add để nhập 3 việc!", chat_id)
+        return
+
+    done_count = sum(1 for t in tasks if t.status == S_DONE)
+    streak = calculate_current_streak(today, recent)
+    tg_send(
+        f"📋 <b>3 việc hôm nay</b>\n\n"
+        + format_task_list(tasks)
+        + f"\n\n📊 {done_count}/3 | 🔥 Streak: {streak}",
+        chat_id
+    )
+
+
+def cmd_streak(chat_id, today):
+    recent = get_recent_tasks(today)
+    streak = calculate_current_streak(today, recent)
+    # Check hôm nay nếu đã xong hết thì +1
+    today_tasks = tasks_on(recent, today.isoformat())
+    today_done = len(today_tasks) >= 3 and all(t.status == S_DONE for t in today_tasks)
+    display_streak = streak + 1 if today_done else streak
+
+    emoji = next(e for n, e in _STREAK_EMOJI if display_streak >= n)
+
+    tg_send(
+        f"{emoji} <b>STREAK: {display_streak} ngày</b>\n\n"
+        + ("Giữ lửa nha Sếp! 💪" if display_streak > 0 else "Bắt đầu lại từ hôm nay! 🚀"),
+        chat_id
+    )
+
+
+def cmd_done(chat_id, today, arg):
+    """/done N — arg là chuỗi số đã qua CMD_DONE_RE (None nếu sai cú pháp)"""
+    if arg is None:
+        tg_send("⚠️ Dùng: /done 1 hoặc /done 2 hoặc /done 3", chat_id)
+        return
+
+    num = int(arg)
+    if num < 1 or num > 3:
+        tg_send("⚠️ Chỉ có việc 1, 2, 3 thôi Sếp!", chat_id)
+        return
+
+    tasks = get_today_tasks(today)
+    target = None
+    for t in tasks:
+        if t.order == num:
+            target = t
+            break
+
+    if not target:
+        tg_send(f"⚠️ Không tìm thấy việc số {num} hôm nay.", chat_id)
+        return
+
+    if target.status == S_DONE:
+        tg_send(f"✅ Việc {num} đã xong rồi!", chat_id)
+        return
+
+    # Check 3/3 chưa — biết trước khi PATCH; streak (tính từ hôm qua) không phụ thuộc
+    # việc hôm nay → query streak chạy song song với PATCH
+    done_count = sum(1 for t in tasks if t.status == S_DONE) + 1
+    streak_f = POOL.submit(calculate_current_streak, today) if done_count >= 3 else None
+
+    notion_update(target.id, {P_STATUS: {"select": {"name": S_DONE}}})
+    title = target.title
+
+    if streak_f:
+        streak = streak_f.result()
+        tg_send(
+            f"✅ <b>Xong: {title}</b>\n\n"
+            f"🎉 PERFECT DAY! 3/3 hoàn thành!\n"
+            f"🔥 Streak: {streak + 1} ngày!",
+            chat_id
+        )
+    else:
+        tg_send(
+            f"✅ <b>Xong: {title}</b>\n"
+            f"📊 Tiến độ: {done_count}/3",
+            chat_id
+        )
+
+
+def cmd_add(chat_id, today):
+    existing = get_today_tasks(today)
+    if len(existing) >= 3:
+        tg_send(
+            "⚠️ Hôm nay đã có 3 việc rồi!\n\n"
+            + format_task_list(existing),
+            chat_id
+        )
+        return
+
+    WAITING_TASKS.add(chat_id)
+    tg_send("📝 Gửi 3 dòng, mỗi dòng 1 việc 👇", chat_id)
+
+
+# Lệnh không tham số → handler(chat_id, today)
+COMMANDS = {
+    "/start": cmd_start,
+    "/status": cmd_status,
+    "/streak": cmd_streak,
+    "/add": cmd_add,
+}
+# "/done 2" (cho phép chữ thừa phía sau như trước: "/done 2 xong rồi")
+CMD_DONE_RE = re.compile(r"/done\s+(\d+)(?:\s.*)?", re.ASCII | re.DOTALL)
+
+
+def handle_task_input(text, chat_id, today):
     """Xử lý khi Sếp gửi 3 việc"""
-    lines = [l.strip() for l in text.strip().split("\n") if l.strip()]
+    # strip mỗi dòng 1 lần, chỉ lấy tới 3 dòng khác rỗng (splitlines xử lý cả \r\n)
+    lines = list(islice(filter(None, map(str.strip, text.splitlines())), 3))
 
     if len(lines) < 3:
         tg_send(
@@ -572,19 +1137,21 @@ def handle_task_input(text, chat_id):
             "Gửi lại 3 việc nha 👇",
             chat_id
         )
-        return jsonify({"ok": True}), 200
+        return
 
-    # Lấy 3 dòng đầu
-    tasks = lines[:3]
-    date = today_str()
-    streak = calculate_current_streak()
+    # Nhận lượt nhập (remove nguyên tử): 2 worker cùng nhận 2 tin → chỉ 1 tin tạo task
+    try:
+        WAITING_TASKS.remove(chat_id)
+    except KeyError:
+        return
 
-    success = 0
-    for i, task_name in enumerate(tasks, 1):
-        if notion_create(task_name, date, i, streak):
-            success += 1
+    tasks = lines
+    date = today.isoformat()
+    streak = calculate_current_streak(today)
 
-    WAITING_TASKS.pop(chat_id, None)
+    # 3 lần tạo page độc lập → chạy song song trên POOL
+    futures = [POOL.submit(notion_create, name, date, i, streak) for i, name in enumerate(tasks, 1)]
+    success = sum(f.result() for f in futures)
 
     if success == 3:
         tg_send(
@@ -598,10 +1165,19 @@ def handle_task_input(text, chat_id):
     else:
         tg_send(f"⚠️ Tạo được {success}/3 task. Kiểm tra lại Notion DB.", chat_id)
 
-    return jsonify({"ok": True}), 200
+
+def _title_from_keyboard(callback, cb_data):
+    """Lấy title từ nút đã bấm ("✅ 1. Title") khi task không thuộc hôm nay"""
+    kb = callback.get("message", {}).get("reply_markup", {}).get("inline_keyboard", [])
+    for row in kb:
+        for btn in row:
+            if btn.get("callback_data") == cb_data:
+                label = btn.get("text", "").removeprefix("✅").strip()
+                return label.split(". ", 1)[-1] or "—"
+    return "—"
 
 
-def handle_callback(callback):
+def handle_callback(callback, today):
     """Xử lý khi Sếp bấm nút inline"""
     cb_data = callback.get("data", "")
     cb_id = callback.get("id")
@@ -610,39 +1186,39 @@ def handle_callback(callback):
     # Answer callback
     if TELEGRAM_TOKEN and cb_id:
         try:
-            requests.post(
+            TG_SESSION.post(
                 f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerCallbackQuery",
-                json={"callback_query_id": cb_id},
-                timeout=5,
+                data=orjson.dumps({"callback_query_id": cb_id}),
+                timeout=(3.05, 5),
             )
-        except:
-            pass
+        except requests.RequestException as e:
+            log.warning("[TG ANSWER ERR] %s", e)
 
     if not cb_data.startswith("done:"):
-        return jsonify({"ok": True}), 200
+        return
 
     page_id = cb_data.replace("done:", "")
 
+    # List hôm nay còn trong cache + sắp đủ 3/3 → query streak song song với PATCH.
+    # Không có cache thì thôi đoán, không fetch riêng (đã đọc lại sau PATCH bên dưới)
+    before = peek_tasks_on(today.isoformat())
+    if before and sum(1 for t in before if t.status == S_DONE or t.id == page_id) >= 3:
+        streak_f = POOL.submit(calculate_current_streak, today)
+    else:
+        streak_f = None
+
     # Update status = Xong
     notion_update(page_id, {P_STATUS: {"select": {"name": S_DONE}}})
 
-    # Lấy title
-    try:
-        r = requests.get(
-            f"https://api.notion.com/v1/pages/{page_id}",
-            headers=NOTION_HEADERS, timeout=10
-        )
-        page = r.json()
-        title = get_title(page)
-    except:
-        title = "—"
-
-    # Check tiến độ
-    tasks = get_today_tasks()
-    done_count = sum(1 for t in tasks if get_status(t) == S_DONE)
+    # Đếm lại SAU khi PATCH (ghi đã xoá cache → đọc mới): lần bấm trước vừa xong cũng được tính
+    tasks = get_today_tasks(today)
+    title = next((t.title for t in tasks if t.id == page_id), None)
+    if title is None:
+        title = _title_from_keyboard(callback, cb_data)
+    done_count = sum(1 for t in tasks if t.status == S_DONE or t.id == page_id)
 
     if done_count >= 3:
-        streak = calculate_current_streak()
+        streak = streak_f.result() if streak_f else calculate_current_streak(today)
         tg_send(
             f"✅ <b>Xong: {title}</b>\n\n"
             f"🎉 PERFECT DAY! 3/3!\n"
@@ -657,8 +1233,6 @@ def handle_callback(callback):
             chat_id
         )
 
-    return jsonify({"ok": True}), 200
-
 
 # ═══════════════════════════════════════════════════════════════
 # ROUTES
@@ -678,40 +1252,126 @@ def wake():
 # SCHEDULER
 # ═══════════════════════════════════════════════════════════════
 
+SCHED = None
+
+
 def start_scheduler():
-    sched = BackgroundScheduler(timezone="Asia/Ho_Chi_Minh")
+    global SCHED
+    SCHED = sched = BackgroundScheduler(
+        timezone=TZ,
+        # Job chạy I/O đồng bộ trên pool riêng → job dài không chặn tick của job khác
+        executors={"default": SchedulerPool(SCHED_WORKERS, pool_kwargs={"thread_name_prefix": "sched"})},
+        # Render free có thể ngủ/chậm → vẫn chạy job trễ trong 1h, gộp lần lỡ, không chạy chồng
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 3600},
+    )
     sched.add_job(job_morning, "cron", hour=9, minute=0, id="morning")
     sched.add_job(job_evening, "cron", hour=21, minute=0, id="evening")
     sched.add_job(job_midnight, "cron", hour=0, minute=5, id="midnight")
     sched.add_job(job_weekly, "cron", day_of_week="sun", hour=20, minute=0, id="weekly")
     sched.start()
-    print(f"[SCHEDULER] Started — 9h/21h/0h05/CN20h ({TZ})")
+    log.info("[SCHEDULER] Started — 9h/21h/0h05/CN20h (%s)", TZ)
 
 
 def set_webhook():
     if TELEGRAM_TOKEN and WEBHOOK_URL:
         url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook"
         try:
-            r = requests.post(url, json={"url": WEBHOOK_URL}, timeout=10)
-            print(f"[WEBHOOK] {r.status_code} — {r.json()}")
-        except Exception as e:
-            print(f"[WEBHOOK ERR] {e}")
+            payload = {
+                "url": WEBHOOK_URL,
+                "max_connections": TG_MAX_CONN,
+                "allowed_updates": TG_ALLOWED_UPDATES,
+            }
+            if WEBHOOK_SECRET:
+                payload["secret_token"] = WEBHOOK_SECRET
+            r = TG_SESSION.post(url, data=orjson.dumps(payload), timeout=TG_TIMEOUT)
+            log.info("[WEBHOOK] %s — %s", r.status_code, r.text[:300])
+        except requests.RequestException as e:
+            log.error("[WEBHOOK ERR] %s", e)
+
+
+_POLL_STOP = threading.Event()
+
+
+def poll_updates():
+    """Long polling getUpdates (TG_POLLING=1, không dùng webhook) → đẩy update vào UPDATE_Q như webhook"""
+    base = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
+    try:
+        # Còn webhook cũ thì getUpdates trả 409
+        TG_SESSION.post(f"{base}/deleteWebhook", timeout=TG_TIMEOUT)
+    except requests.RequestException as e:
+        log.warning("[POLL] deleteWebhook lỗi: %s", e)
+
+    params = {
+        "timeout": TG_POLL_TIMEOUT,
+        "allowed_updates": orjson.dumps(TG_ALLOWED_UPDATES).decode(),
+    }
+    log.info("[POLL] Long polling getUpdates (timeout=%ss)", TG_POLL_TIMEOUT)
+    _ensure_update_workers()
+    while not _POLL_STOP.is_set():
+        try:
+            r = TG_SESSION.get(f"{base}/getUpdates", params=params,
+                               timeout=(3.05, TG_POLL_TIMEOUT + 10))
+            if r.status_code != 200:
+                raise requests.HTTPError(f"{r.status_code} {r.text[:200]}")
+            updates = orjson.loads(r.content).get("result") or []
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            log.warning("[POLL ERR] %s", e)
+            _POLL_STOP.wait(5)
+            continue
+
+        for upd in updates:
+            params["offset"] = upd["update_id"] + 1
+            if _mark_update_seen(upd["update_id"]):
+                # Hàng đợi đầy → chờ (backpressure), không bỏ update
+                UPDATE_Q.put(upd)
 
 
 # ═══════════════════════════════════════════════════════════════
 # MAIN
 # ═══════════════════════════════════════════════════════════════
 
-if __name__ == "__main__":
-    print("=" * 50)
-    print("🏋️  KỶ LUẬT 3 VIỆC/NGÀY")
-    print("=" * 50)
-    print(f"DB: {NOTION_DB_ID[:12]}...")
-    print(f"Chat: {CHAT_ID}")
+_BOOTED = threading.Event()
+_RULE = "=" * 50
+STARTUP_BANNER = f"{_RULE}\n🏋️  KỶ LUẬT 3 VIỆC/NGÀY\n{_RULE}\nDB: {NOTION_DB_ID[:12]}...\nChat: {CHAT_ID}"
+SHUTDOWN_DRAIN = 5  # giây chờ gửi nốt tin trong hàng đợi khi tắt
+
 
-    set_webhook()
+def shutdown():
+    """Dừng scheduler + gửi nốt tin đang chờ (Render gửi SIGTERM trước SIGKILL)"""
+    _POLL_STOP.set()
+    if SCHED and SCHED.running:
+        SCHED.shutdown(wait=False)
+    deadline = time.monotonic() + SHUTDOWN_DRAIN
+    while TG_OUT_Q.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.1)
+    log.info("[SHUTDOWN] done")
+    LOG_LISTENER.stop()  # flush nốt log còn trong queue
+
+
+def bootstrap():
+    """Set webhook (hoặc long polling) + start scheduler — chỉ 1 lần mỗi process"""
+    if _BOOTED.is_set():
+        return
+    _BOOTED.set()
+
+    log.info("\n%s", STARTUP_BANNER)
+
+    # setWebhook / getUpdates là call mạng → chạy nền, server nhận request (/health) ngay
+    if WEBHOOK_URL:
+        threading.Thread(target=set_webhook, name="set-webhook", daemon=True).start()
+    elif TELEGRAM_TOKEN and TG_POLLING:
+        threading.Thread(target=poll_updates, name="tg-poll", daemon=True).start()
+    # Schema (id cho filter_properties) tải song song → query đầu tiên khỏi chờ thêm 1 GET
+    if NOTION_TOKEN and NOTION_DB_ID:
+        POOL.submit(get_db_schema)
     start_scheduler()
+    atexit.register(shutdown)
+
+
+if __name__ == "__main__":
+    # SIGTERM → SystemExit để atexit (shutdown) chạy; gunicorn tự lo signal của nó
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    bootstrap()
 
-    port = int(os.getenv("PORT", 5000))
-    print(f"[SERVER] Running on port {port}")
-    app.run(host="0.0.0.0", port=port, threaded=True)
+    log.info("[SERVER] Running on port %s", PORT)
+    app.run(host="0.0.0.0", port=PORT, threaded=True)